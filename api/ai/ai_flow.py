@@ -1,10 +1,17 @@
 import os
+import re
 import json
+import orjson
 import logging
 import anthropic
+import httpx
 import io
-import base64
-from typing import Dict, Any, Optional, Tuple
+import time
+import asyncio
+import hashlib
+import functools
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional, Tuple
 from dotenv import load_dotenv
 from PIL import Image, ImageDraw, ImageFont
 
@@ -15,6 +22,197 @@ logger = logging.getLogger(__name__)
 # Load environment variables from .env file
 load_dotenv()
 
+# Static system prompts, sent with cache_control. The marker only takes effect once the
+# cached prefix reaches the model's minimum (2048 tokens for Haiku, 1024 for Sonnet);
+# these prompts are well below that today, so the API ignores it until they grow.
+CONCEPT_SYSTEM_PROMPT = """You are an expert meme creator who excels at crafting witty, impactful memes.
+Your task is to generate a meme concept based on the provided context.
+
+Your output must be a JSON object with the following structure:
+{
+  "title": "Brief, catchy title for the meme",
+  "text": {
+    "top_text": "Text for the top of the meme (optional)",
+    "bottom_text": "Text for the bottom of the meme (optional)",
+    "additional_text": "Any additional text elements (optional)"
+  },
+  "style": {
+    "background_color": "Suggested background color (hex code)",
+    "text_color": "Suggested text color (hex code)",
+    "font": "Suggested font family"
+  },
+  "description": "Brief description of the visual concept"
+}
+
+Make the meme humorous, relevant to the context, and visually simple enough to be represented as an SVG.
+"""
+
+SVG_SYSTEM_PROMPT = """You are an expert SVG creator specializing in meme backgrounds.
+Your task is to create a simple SVG background for a meme based on the provided concept.
+
+The SVG should:
+1. Be complete and valid SVG code that can be directly used in a browser
+2. Include all necessary SVG tags and attributes
+3. Create a simple background that matches the meme concept
+4. NOT include any text elements - text will be added separately
+5. Have a width of 600px and height of 600px
+6. Use simple shapes, gradients, or patterns that would work well as a meme background
+
+Your response must contain ONLY the complete SVG code with no additional text or explanation.
+"""
+
+# Sampling temperatures; also part of each response cache key
+CONCEPT_TEMPERATURE = 0.7
+SVG_TEMPERATURE = 0.3
+
+# Outermost <svg>...</svg> block; greedy so nested <svg> elements stay intact
+_SVG_RE = re.compile(r"<svg\b.*</svg>", re.DOTALL)
+
+# Layout limits for meme text on the 600x600 canvas: lines stay within a 20px
+# side margin and each block (top, bottom) stays inside its own half
+MEME_TEXT_MAX_WIDTH = 560
+MEME_TEXT_MAX_HEIGHT = 260
+MEME_STROKE_WIDTH = 3
+
+# Font sizes tried from largest to smallest until a block fits
+MEME_FONT_SIZES = (48, 42, 36, 30, 26, 22, 18)
+
+MEME_FONT_PATH = os.getenv("MEME_FONT_PATH", "Impact.ttf")
+
+@functools.lru_cache(maxsize=None)
+def _meme_font(size: int) -> ImageFont.FreeTypeFont:
+    """Load the meme font at size once; falls back to PIL's default if Impact is missing."""
+    try:
+        return ImageFont.truetype(MEME_FONT_PATH, size)
+    except OSError:
+        logger.warning(f"Font {MEME_FONT_PATH} not found, using PIL default font")
+        return ImageFont.load_default(size=size)
+
+@functools.lru_cache(maxsize=None)
+def _max_meme_lines(size: int) -> int:
+    """Return how many stroked lines at size fit within MEME_TEXT_MAX_HEIGHT."""
+    draw = ImageDraw.Draw(Image.new("L", (1, 1)))
+    font = _meme_font(size)
+    count = 1
+    while True:
+        # Probe with descenders so the last line's full height is counted
+        left, top, right, bottom = draw.multiline_textbbox(
+            (0, 0), "\n".join(["AGJQ|gy"] * (count + 1)), font=font, stroke_width=MEME_STROKE_WIDTH
+        )
+        if bottom - top > MEME_TEXT_MAX_HEIGHT:
+            return count
+        count += 1
+
+def _wrap_text(text: str, font: ImageFont.FreeTypeFont, max_width: int) -> List[str]:
+    """Wrap text into lines no wider than max_width pixels, splitting words that are too wide."""
+    # Each word is measured once; a line's width is its word widths plus the spaces
+    space_width = font.getlength(" ")
+    lines: List[str] = []
+    current: List[str] = []
+    width = 0.0
+    for word in text.split():
+        word_width = font.getlength(word)
+        if current and width + space_width + word_width <= max_width:
+            current.append(word)
+            width += space_width + word_width
+            continue
+        if current:
+            lines.append(" ".join(current))
+        if word_width <= max_width:
+            current, width = [word], word_width
+            continue
+        # A single word wider than the line is broken across lines by character
+        chunk, width = "", 0.0
+        for char in word:
+            char_width = font.getlength(char)
+            if chunk and width + char_width > max_width:
+                lines.append(chunk)
+                chunk, width = "", 0.0
+            chunk += char
+            width += char_width
+        current = [chunk]
+    if current:
+        lines.append(" ".join(current))
+    return lines
+
+def _layout_meme_text(text: str) -> Tuple[str, ImageFont.FreeTypeFont]:
+    """
+    Fit text into one meme text block.
+    
+    Returns the wrapped text and the largest font size whose lines fit within
+    MEME_TEXT_MAX_HEIGHT; at the smallest size, lines that do not fit are dropped.
+    """
+    # Text width scales with font size, so one measurement at the largest size
+    # gives a lower bound on the line count and sizes that cannot fit are skipped
+    largest = MEME_FONT_SIZES[0]
+    full_width = _meme_font(largest).getlength(" ".join(text.split()))
+    for size in MEME_FONT_SIZES:
+        max_lines = _max_meme_lines(size)
+        if size != MEME_FONT_SIZES[-1] and full_width * size / largest > max_lines * MEME_TEXT_MAX_WIDTH:
+            continue
+        font = _meme_font(size)
+        lines = _wrap_text(text, font, MEME_TEXT_MAX_WIDTH)
+        if len(lines) <= max_lines:
+            break
+    return "\n".join(lines[:max_lines]), font
+
+# PIL's default font, loaded once instead of on every error-image draw
+_DEFAULT_FONT = ImageFont.load_default()
+
+def normalize_context(context: str) -> str:
+    """Case-fold a context and collapse whitespace for cache lookups."""
+    return " ".join(context.casefold().split())
+
+class PromptCache:
+    """
+    In-process LRU cache of Claude responses keyed by the exact request.
+
+    Entries expire after ``ttl`` seconds, so repeated contexts skip the
+    round-trip while older generations still age out.
+    """
+
+    def __init__(self, maxsize: int = 256, ttl: float = 600.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+
+    @staticmethod
+    def make_key(*parts: Any) -> str:
+        """Build a SHA-256 key from the parts that determine a response."""
+        digest = hashlib.sha256()
+        for part in parts:
+            digest.update(str(part).encode("utf-8"))
+            digest.update(b"\x00")
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached value for key, or None if missing or expired."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: str) -> None:
+        """Store value under key, evicting the least recently used entries."""
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+# Shared across MemeGenerator instances so hits survive per-request generators
+_response_cache = PromptCache(
+    maxsize=int(os.getenv("MEME_CACHE_SIZE", "256")),
+    ttl=float(os.getenv("MEME_CACHE_TTL", "600")),
+)
+
+# Caps in-flight Claude calls across all requests to stay within the rate limit
+_claude_semaphore = asyncio.Semaphore(int(os.getenv("ANTHROPIC_MAX_CONCURRENCY", "8")))
+
 class MemeGenerator:
     def __init__(self):
         """Initialize the MemeGenerator with Anthropic API client."""
@@ -24,8 +222,13 @@ class MemeGenerator:
             logger.error("ANTHROPIC_API_KEY environment variable is not set")
             raise ValueError("ANTHROPIC_API_KEY environment variable is not set")
         
-        # Initialize Anthropic client
-        self.client = anthropic.Anthropic(api_key=self.api_key)
+        # Initialize Anthropic client with a keep-alive pool that is reused across requests
+        self.client = anthropic.AsyncAnthropic(
+            api_key=self.api_key,
+            http_client=anthropic.DefaultAsyncHttpxClient(
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=32)
+            )
+        )
         self.model = os.getenv("CLAUDE_MODEL", "claude-3-5-haiku-20241022")
         logger.info(f"MemeGenerator initialized with model: {self.model}")
 
@@ -44,11 +247,12 @@ class MemeGenerator:
         # Step 1: Generate meme concept and text
         meme_concept = await self._generate_meme_concept(context)
         
-        # Step 2: Generate SVG based on the concept (without text)
-        svg_data = await self._generate_svg(context, meme_concept)
-        
-        # Step 3: Generate a complete image with text directly from Claude
-        image_data, image_format = await self._generate_image_with_text(context, meme_concept)
+        # Steps 2 and 3 only depend on the concept, so run them concurrently:
+        # an SVG background (without text) and a complete image with text
+        svg_data, (image_data, image_format) = await asyncio.gather(
+            self._generate_svg(context, meme_concept),
+            self._generate_image_with_text(context, meme_concept)
+        )
         
         return {
             "concept": meme_concept,
@@ -69,51 +273,46 @@ class MemeGenerator:
         """
         logger.info("Generating meme concept...")
         
-        system_prompt = """You are an expert meme creator who excels at crafting witty, impactful memes.
-Your task is to generate a meme concept based on the provided context.
-
-Your output must be a JSON object with the following structure:
-{
-  "title": "Brief, catchy title for the meme",
-  "text": {
-    "top_text": "Text for the top of the meme (optional)",
-    "bottom_text": "Text for the bottom of the meme (optional)",
-    "additional_text": "Any additional text elements (optional)"
-  },
-  "style": {
-    "background_color": "Suggested background color (hex code)",
-    "text_color": "Suggested text color (hex code)",
-    "font": "Suggested font family"
-  },
-  "description": "Brief description of the visual concept"
-}
-
-Make the meme humorous, relevant to the context, and visually simple enough to be represented as an SVG.
-"""
-        
         user_prompt = f"""Create a meme concept based on this context:
 
 {context}
 
 Return only the JSON object with no additional text."""
         
+        # Key on the normalized context so casing/spacing variants share a concept;
+        # blank contexts are never cached since they say nothing about the meme
+        normalized_context = normalize_context(context)
+        cache_key = (
+            PromptCache.make_key(self.model, CONCEPT_TEMPERATURE, CONCEPT_SYSTEM_PROMPT, normalized_context)
+            if normalized_context else None
+        )
+        
         try:
-            response = self.client.messages.create(
-                model=self.model,
-                max_tokens=1000,
-                temperature=0.7,
-                system=system_prompt,
-                messages=[
-                    {"role": "user", "content": user_prompt}
-                ]
-            )
-            
-            content = response.content[0].text
+            content = _response_cache.get(cache_key) if cache_key else None
+            # Only fresh responses are stored, so hits never extend an entry's TTL
+            cache_miss = content is None
+            if cache_miss:
+                async with _claude_semaphore:
+                    response = await self.client.messages.create(
+                        model=self.model,
+                        max_tokens=1000,
+                        temperature=CONCEPT_TEMPERATURE,
+                        system=[{"type": "text", "text": CONCEPT_SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}}],
+                        messages=[
+                            {"role": "user", "content": user_prompt}
+                        ]
+                    )
+                
+                content = response.content[0].text
+            else:
+                logger.info("Using cached meme concept response")
             
             # Parse the JSON response
             try:
-                meme_concept = json.loads(content)
+                meme_concept = orjson.loads(content)
                 logger.info(f"Successfully generated meme concept: {meme_concept['title']}")
+                if cache_key and cache_miss:
+                    _response_cache.set(cache_key, content)
                 return meme_concept
             except json.JSONDecodeError as e:
                 logger.error(f"Failed to parse meme concept JSON: {e}")
@@ -150,50 +349,45 @@ Return only the JSON object with no additional text."""
         """
         logger.info("Generating SVG background for meme...")
         
-        system_prompt = """You are an expert SVG creator specializing in meme backgrounds.
-Your task is to create a simple SVG background for a meme based on the provided concept.
-
-The SVG should:
-1. Be complete and valid SVG code that can be directly used in a browser
-2. Include all necessary SVG tags and attributes
-3. Create a simple background that matches the meme concept
-4. NOT include any text elements - text will be added separately
-5. Have a width of 600px and height of 600px
-6. Use simple shapes, gradients, or patterns that would work well as a meme background
-
-Your response must contain ONLY the complete SVG code with no additional text or explanation.
-"""
-        
         user_prompt = f"""Create a simple SVG background for a meme based on this concept:
 
 Original Context: {context}
 
 Meme Concept:
-{json.dumps(meme_concept, indent=2)}
+{orjson.dumps(meme_concept, option=orjson.OPT_INDENT_2).decode()}
 
 IMPORTANT: Do NOT include any text elements in the SVG. The text will be added separately.
 Return ONLY the complete SVG code with no additional text."""
         
+        cache_key = PromptCache.make_key(self.model, SVG_TEMPERATURE, SVG_SYSTEM_PROMPT, user_prompt)
+        
         try:
-            response = self.client.messages.create(
-                model=self.model,
-                max_tokens=2000,
-                temperature=0.3,
-                system=system_prompt,
-                messages=[
-                    {"role": "user", "content": user_prompt}
-                ]
-            )
-            
-            content = response.content[0].text
+            content = _response_cache.get(cache_key)
+            cache_miss = content is None
+            if cache_miss:
+                async with _claude_semaphore:
+                    response = await self.client.messages.create(
+                        model=self.model,
+                        max_tokens=2000,
+                        temperature=SVG_TEMPERATURE,
+                        system=[{"type": "text", "text": SVG_SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}}],
+                        messages=[
+                            {"role": "user", "content": user_prompt}
+                        ]
+                    )
+                
+                content = response.content[0].text
+            else:
+                logger.info("Using cached SVG response")
             
             # Extract SVG code (in case there's any extra text)
-            svg_start = content.find("<svg")
-            svg_end = content.rfind("</svg>") + 6
+            svg_match = _SVG_RE.search(content)
             
-            if svg_start >= 0 and svg_end > svg_start:
-                svg_data = content[svg_start:svg_end]
+            if svg_match:
+                svg_data = svg_match.group(0)
                 logger.info(f"Successfully generated SVG meme ({len(svg_data)} bytes)")
+                if cache_miss:
+                    _response_cache.set(cache_key, svg_data)
                 return svg_data
             else:
                 logger.error("Failed to extract SVG from response")
@@ -211,7 +405,10 @@ Return ONLY the complete SVG code with no additional text."""
 
     async def _generate_image_with_text(self, context: str, meme_concept: Dict[str, Any]) -> Tuple[bytes, str]:
         """
-        Generate a complete meme image with text directly from Claude.
+        Render a complete meme image with text locally.
+        
+        Claude is a text model and cannot return usable PNG bytes, so the image
+        is drawn with PIL in a worker thread instead of asking Claude for base64.
         
         Args:
             context: Original user context
@@ -221,88 +418,11 @@ Return ONLY the complete SVG code with no additional text."""
             Tuple of (image_data_bytes, format_string)
         """
         logger.info("Generating complete meme image with text...")
-        
-        system_prompt = """You are an expert meme creator who excels at creating visual memes.
-Your task is to create a complete meme image based on the provided concept.
-
-The image should:
-1. Be a PNG image encoded as base64
-2. Have a resolution of 600x600 pixels
-3. Include the text from the meme concept (top text and bottom text)
-4. Use the CLASSIC MEME STYLE with:
-   - LARGE, BOLD WHITE TEXT (not black or dark text)
-   - THICK BLACK OUTLINE around the text for visibility
-   - Text positioned at the TOP and BOTTOM of the image
-   - ALL CAPS text for maximum impact
-5. Use a visually interesting background that matches the concept:
-   - Bright, high-contrast colors
-   - Simple patterns or gradients
-   - Or a solid color that provides good contrast with the white text
-
-Your response must contain ONLY the complete base64-encoded PNG image with no additional text or explanation.
-Do not include any markdown formatting, just the raw base64 string.
-"""
-        
-        user_prompt = f"""Create a complete meme image based on this concept:
-
-Original Context: {context}
-
-Meme Concept:
-{json.dumps(meme_concept, indent=2)}
-
-IMPORTANT: Follow the classic meme style with:
-- LARGE, BOLD WHITE TEXT (not black or dark text)
-- THICK BLACK OUTLINE around the text
-- Text at the TOP and BOTTOM of the image
-- ALL CAPS text for maximum impact
-- High contrast background
-
-Return ONLY the base64-encoded PNG image with no additional text or explanation.
-Do not include any markdown formatting or prefixes like "data:image/png;base64,".
-"""
-        
-        try:
-            response = self.client.messages.create(
-                model=self.model,
-                max_tokens=4000,  # Increased for image data
-                temperature=0.3,
-                system=system_prompt,
-                messages=[
-                    {"role": "user", "content": user_prompt}
-                ]
-            )
-            
-            content = response.content[0].text.strip()
-            
-            # Clean up the base64 string (remove any markdown or prefixes)
-            if "base64," in content:
-                # Extract just the base64 part if there's a prefix
-                content = content.split("base64,")[1]
-            
-            # Remove any non-base64 characters
-            content = ''.join(c for c in content if c in 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/=')
-            
-            try:
-                # Decode base64 to binary
-                image_data = base64.b64decode(content)
-                logger.info(f"Successfully generated meme image ({len(image_data)} bytes)")
-                
-                # Verify it's a valid image by trying to open it
-                Image.open(io.BytesIO(image_data))
-                
-                return image_data, "PNG"
-            except Exception as e:
-                logger.error(f"Error decoding base64 image: {e}")
-                # Fall back to creating a simple image with PIL
-                return self._create_fallback_image(meme_concept)
-                
-        except Exception as e:
-            logger.error(f"Error generating image: {str(e)}")
-            return self._create_fallback_image(meme_concept)
+        return await asyncio.to_thread(self._render_meme_image, meme_concept)
     
-    def _create_fallback_image(self, meme_concept: Dict[str, Any]) -> Tuple[bytes, str]:
-        """Create a fallback image with PIL if Claude fails to generate one."""
-        logger.info("Creating fallback image with PIL...")
+    def _render_meme_image(self, meme_concept: Dict[str, Any]) -> Tuple[bytes, str]:
+        """Render the meme concept in classic meme style (white text, black outline) with PIL."""
+        logger.info("Creating meme image with PIL...")
         
         try:
             # Create a new image
@@ -313,36 +433,48 @@ Do not include any markdown formatting or prefixes like "data:image/png;base64,"
             top_text = meme_concept.get("text", {}).get("top_text", "")
             bottom_text = meme_concept.get("text", {}).get("bottom_text", "")
             
-            # Use default font
-            font = ImageFont.load_default()
-            
-            # Add top text
+            # Add top text, hanging from the top edge
             if top_text:
-                draw.text((300, 100), top_text, fill="#000000", anchor="mm", font=font)
+                lines, font = _layout_meme_text(top_text.upper())
+                draw.multiline_text((300, 20), lines,
+                                    fill="white", stroke_width=MEME_STROKE_WIDTH, stroke_fill="black",
+                                    anchor="ma", align="center", font=font)
             
-            # Add bottom text
+            # Add bottom text, sitting on the bottom edge
             if bottom_text:
-                draw.text((300, 500), bottom_text, fill="#000000", anchor="mm", font=font)
+                lines, font = _layout_meme_text(bottom_text.upper())
+                draw.multiline_text((300, 580), lines,
+                                    fill="white", stroke_width=MEME_STROKE_WIDTH, stroke_fill="black",
+                                    anchor="md", align="center", font=font)
             
             # Save image to bytes
             output = io.BytesIO()
-            image.save(output, format="PNG")
+            image.save(output, format="PNG", compress_level=1)
             image_data = output.getvalue()
             
-            logger.info(f"Successfully created fallback meme image ({len(image_data)} bytes)")
+            logger.info(f"Successfully created meme image ({len(image_data)} bytes)")
             return image_data, "PNG"
             
         except Exception as e:
-            logger.error(f"Error creating fallback image: {e}")
+            logger.error(f"Error creating meme image: {e}")
             # Create an even simpler fallback
             image = Image.new("RGB", (600, 600), color="#FFFFFF")
             draw = ImageDraw.Draw(image)
-            draw.text((50, 250), "Error creating meme image", fill="#000000")
+            draw.text((50, 250), "Error creating meme image", fill="#000000", font=_DEFAULT_FONT)
             
             output = io.BytesIO()
-            image.save(output, format="PNG")
+            image.save(output, format="PNG", compress_level=1)
             return output.getvalue(), "PNG"
 
+_generator: Optional[MemeGenerator] = None
+
+def get_meme_generator() -> MemeGenerator:
+    """Return the process-wide MemeGenerator, creating it on first use."""
+    global _generator
+    if _generator is None:
+        _generator = MemeGenerator()
+    return _generator
+
 async def create_meme(context: str) -> Dict[str, Any]:
     """
     Create a meme using Claude API based on user context.
@@ -353,5 +485,4 @@ async def create_meme(context: str) -> Dict[str, Any]:
     Returns:
         Dictionary containing the image data, SVG data, and meme concept
     """
-    generator = MemeGenerator()
-    return await generator.create_meme_from_context(context)
+    return await get_meme_generator().create_meme_from_context(context)
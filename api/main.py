@@ -3,9 +3,14 @@ from pydantic import BaseModel
 from typing import List, Optional, Dict, Any
 import os
 import asyncio
-import tempfile
+import functools
+import threading
+import io
+import re
 import json
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import uuid
 from concurrent.futures import ThreadPoolExecutor
 import logging
@@ -25,11 +30,52 @@ app = FastAPI(title="Memeulacra API")
 
 # Database connection
 DATABASE_URL = f"postgresql://{os.getenv('POSTGRES_USER', 'memeuser')}:{os.getenv('POSTGRES_PASSWORD', 'memepass')}@db:5432/{os.getenv('POSTGRES_DB', 'memedb')}"
-engine = create_engine(DATABASE_URL)
+engine = create_engine(DATABASE_URL, pool_size=20, max_overflow=10, pool_recycle=3600)
 
 # Create a thread pool executor for running CPU-bound tasks
 thread_pool = ThreadPoolExecutor(max_workers=4)
 
+# Pooled HTTP session for image downloads, with retries on transient CDN errors
+http_session = requests.Session()
+http_session.mount("https://", HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=32,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+))
+
+# Connect/read timeouts for image downloads
+IMAGE_DOWNLOAD_TIMEOUT = (5, 30)
+
+# Backslash escape inside a quoted Postgres array element
+_PG_ARRAY_ESCAPE_RE = re.compile(r"\\(.)", re.DOTALL)
+
+# Font for box labels in /overlay-rectangles, loaded once
+LABEL_FONT = ImageFont.load_default()
+
+# S3Uploader uploads through a boto3 resource, which is not thread-safe, so each
+# thread-pool worker keeps its own uploader (and warm connection pool). Construction
+# is serialized because it goes through boto3's shared default session.
+_uploaders = threading.local()
+_uploader_lock = threading.Lock()
+
+def get_uploader() -> S3Uploader:
+    uploader = getattr(_uploaders, "uploader", None)
+    if uploader is None:
+        with _uploader_lock:
+            uploader = _uploaders.uploader = S3Uploader()
+    return uploader
+
+# Default user (meme_lord) id; it never changes, so it is looked up once and reused
+_default_user_id = None
+
+def get_default_user_id(conn):
+    global _default_user_id
+    if _default_user_id is None:
+        _default_user_id = conn.execute(
+            text("SELECT id FROM users WHERE username = 'meme_lord'")
+        ).scalar()
+    return _default_user_id
+
 class MemeRequest(BaseModel):
     template_id: int
     text_boxes: List[str]
@@ -49,9 +95,10 @@ class MemeTemplate(BaseModel):
     tags: List[str]
     popularity_score: float
 
-# This function wraps our CPU-bound operations for the thread pool
+# This function runs blocking or CPU-bound work on the thread pool so the event loop stays free
 async def run_in_threadpool(func, *args, **kwargs):
-    return await func(*args, **kwargs)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(thread_pool, functools.partial(func, *args, **kwargs))
 
 @app.get("/")
 async def root():
@@ -89,43 +136,30 @@ async def list_templates():
 async def generate_meme(request: MemeRequest):
     try:
         with engine.connect() as conn:
-            # Verify template exists and get its details
-            template = conn.execute(
-                text("SELECT text_box_count FROM meme_templates WHERE id = :id"),
-                {"id": request.template_id}
-            ).first()
-            
-            if not template:
-                raise HTTPException(status_code=404, detail="Template not found")
-            
-            if len(request.text_boxes) > template[0]:
-                raise HTTPException(
-                    status_code=400, 
-                    detail=f"Template only supports {template[0]} text boxes"
-                )
-            
-            # Get default user (meme_lord)
-            user_result = conn.execute(
-                text("SELECT id FROM users WHERE username = 'meme_lord'")
-            ).first()
+            user_id = get_default_user_id(conn)
             
-            if not user_result:
+            if not user_id:
                 raise HTTPException(status_code=500, detail="Default user not found")
             
-            user_id = user_result[0]
-            
-            # Insert meme record
-            result = conn.execute(
+            # Check the template and insert the meme record in one round trip;
+            # the insert only happens if the template supports enough text boxes
+            row = conn.execute(
                 text("""
-                    INSERT INTO memes 
-                    (context, template_id, text_box_1, text_box_2, text_box_3, 
-                     text_box_4, text_box_5, text_box_6, text_box_7, 
-                     meme_cdn_url, user_id)
-                    VALUES 
-                    (:context, :template_id, :text_1, :text_2, :text_3,
-                     :text_4, :text_5, :text_6, :text_7,
-                     :cdn_url, :user_id)
-                    RETURNING id
+                    WITH template AS (
+                        SELECT text_box_count FROM meme_templates WHERE id = :template_id
+                    ), inserted AS (
+                        INSERT INTO memes 
+                        (context, template_id, text_box_1, text_box_2, text_box_3, 
+                         text_box_4, text_box_5, text_box_6, text_box_7, 
+                         meme_cdn_url, user_id)
+                        SELECT :context, :template_id, :text_1, :text_2, :text_3,
+                               :text_4, :text_5, :text_6, :text_7,
+                               :cdn_url, :user_id
+                        FROM template
+                        WHERE template.text_box_count >= :text_box_count
+                        RETURNING id
+                    )
+                    SELECT (SELECT text_box_count FROM template), (SELECT id FROM inserted)
                 """),
                 {
                     "context": request.context,
@@ -137,12 +171,24 @@ async def generate_meme(request: MemeRequest):
                     "text_5": request.text_boxes[4] if len(request.text_boxes) > 4 else None,
                     "text_6": request.text_boxes[5] if len(request.text_boxes) > 5 else None,
                     "text_7": request.text_boxes[6] if len(request.text_boxes) > 6 else None,
+                    "text_box_count": len(request.text_boxes),
                     "cdn_url": "https://placeholder-meme-url.com/meme.jpg",  # Placeholder
                     "user_id": user_id
                 }
-            )
+            ).one()
+            
+            text_box_count, meme_id = row
+            
+            if text_box_count is None:
+                raise HTTPException(status_code=404, detail="Template not found")
+            
+            if meme_id is None:
+                raise HTTPException(
+                    status_code=400, 
+                    detail=f"Template only supports {text_box_count} text boxes"
+                )
+            
             conn.commit()
-            meme_id = result.scalar_one()
             
             return {
                 "id": meme_id,
@@ -186,67 +232,107 @@ async def health_check():
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Database connection failed: {str(e)}")
 
-def draw_boxes_on_meme(image_path, boxes_data, output_path):
+def parse_boxes_data(boxes_data):
+    """
+    Parse text box coordinates into a list of box dicts.
+    
+    Accepts an already-parsed list, a JSON string (possibly JSON-encoded twice),
+    or a Postgres JSONB[] literal such as '{"[{\\"id\\": 1, ...}]"}'.
+    """
+    if not isinstance(boxes_data, str):
+        return boxes_data
+    
+    cleaned = boxes_data.strip()
+    # Unwrap a Postgres array literal, whose quoted element backslash-escapes every special char
+    if cleaned.startswith('{"[') and cleaned.endswith(']"}'):
+        cleaned = _PG_ARRAY_ESCAPE_RE.sub(r"\1", cleaned[2:-2])
+    
+    try:
+        boxes = json.loads(cleaned)
+    except json.JSONDecodeError:
+        # Not valid JSON as a whole: retry without stray outer quotes around the array
+        if not (cleaned.startswith('"[') and cleaned.endswith(']"')):
+            raise
+        boxes = json.loads(cleaned[1:-1])
+    # JSON that was encoded twice decodes to a string first
+    if isinstance(boxes, str):
+        boxes = json.loads(boxes)
+    return boxes
+
+def draw_boxes_on_meme(img, boxes_data):
     """
     Draw rectangles on a meme image based on the provided coordinates.
     
     Args:
-        image_path: Path to the input image
+        img: PIL image to draw on (modified in place)
         boxes_data: JSON string containing box coordinates and labels
-        output_path: Path where to save the output image
+        
+    Returns:
+        The annotated PIL image
     """
-    # Load the image
-    img = Image.open(image_path)
     draw = ImageDraw.Draw(img)
     
     # Get image dimensions
     img_width, img_height = img.size
     
-    # Parse the JSON data (fixing the format issue)
-    try:
-        # The data seems to have extra wrapping and quotes
-        # Remove the outer quotes and braces if they exist
-        if isinstance(boxes_data, str):
-            cleaned_data = boxes_data.strip('"{}"')
-            # Now parse the cleaned JSON
-            boxes = json.loads(cleaned_data)
-        else:
-            # If it's already a list/dict, use it directly
-            boxes = boxes_data
-    except json.JSONDecodeError:
-        logger.error("Error parsing JSON data. Trying alternative approach...")
-        # If the above fails, try another approach
-        cleaned_data = boxes_data.replace('\\"', '"').strip('"{}"')
-        boxes = json.loads(cleaned_data)
+    boxes = parse_boxes_data(boxes_data)
+    
+    # Scale factors from percentage coordinates to pixel coordinates
+    scale_x = img_width / 100
+    scale_y = img_height / 100
     
     # Draw each box with its label
     for box in boxes:
-        # Convert percentage coordinates to pixel coordinates
-        x = box["x"] * img_width / 100
-        y = box["y"] * img_height / 100
-        width = box["width"] * img_width / 100
-        height = box["height"] * img_height / 100
-        
         # Calculate box corners
-        x1, y1 = x, y
-        x2, y2 = x + width, y + height
+        x1 = box["x"] * scale_x
+        y1 = box["y"] * scale_y
+        x2 = x1 + box["width"] * scale_x
+        y2 = y1 + box["height"] * scale_y
         
         # Draw rectangle (with some transparency)
         draw.rectangle([x1, y1, x2, y2], outline="red", width=3)
         
         # Add label text (optional)
-        font = ImageFont.load_default()
         label_text = f"Box {box['id']}"
         if 'label' in box and box['label']:
             # Truncate long labels
             label_text += f": {box['label'][:15]}..."
         
         draw.text((x1, y1 - 20), label_text, fill="white", 
-                 stroke_width=2, stroke_fill="black", font=font)
+                 stroke_width=2, stroke_fill="black", font=LABEL_FONT)
+    
+    return img
+
+def overlay_and_upload(image_url, boxes_data):
+    """
+    Download a meme image, draw its text boxes on it and upload the result.
+    
+    Args:
+        image_url: URL of the meme image
+        boxes_data: JSON string containing box coordinates and labels
+        
+    Returns:
+        CDN URL of the annotated image
+    """
+    # Download the image
+    logger.info("Downloading image from: %s", image_url)
+    response = http_session.get(image_url, timeout=IMAGE_DOWNLOAD_TIMEOUT)
+    response.raise_for_status()
+    
+    with Image.open(io.BytesIO(response.content)) as img:
+        # Draw boxes on the image
+        logger.info("Drawing boxes on the image")
+        draw_boxes_on_meme(img, boxes_data)
+        
+        # Upload the modified image to the CDN
+        logger.info("Uploading modified image to CDN")
+        uploader = get_uploader()
+        
+        # Generate a unique ID for the image
+        image_id = str(uuid.uuid4())
+        cdn_url = uploader.upload_image(img, f"rectangle_overlay_{image_id}")
     
-    # Save the result
-    img.save(output_path)
-    logger.info(f"Image saved to {output_path}")
+    return cdn_url
 
 @app.post("/overlay-rectangles")
 async def overlay_rectangles(request: Request):
@@ -266,51 +352,18 @@ async def overlay_rectangles(request: Request):
         image_url = data.get("image_url")
         boxes_data = data.get("boxes_data")
         
-        logger.info(f"Received request to overlay rectangles on image: {image_url}")
-        logger.info(f"Boxes data: {json.dumps(boxes_data)}")
+        logger.info("Received request to overlay rectangles on image: %s", image_url)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Boxes data: %s", json.dumps(boxes_data))
         
         if not image_url or not boxes_data:
             raise HTTPException(status_code=400, detail="Missing image_url or boxes_data")
             
-        # Create temporary files for input and output images
-        with tempfile.NamedTemporaryFile(suffix=".jpg", delete=False) as temp_input:
-            input_path = temp_input.name
-            
-        with tempfile.NamedTemporaryFile(suffix=".jpg", delete=False) as temp_output:
-            output_path = temp_output.name
-            
-        try:
-            # Download the image
-            logger.info(f"Downloading image from: {image_url}")
-            response = requests.get(image_url)
-            response.raise_for_status()
-            
-            with open(input_path, "wb") as f:
-                f.write(response.content)
-                
-            # Draw boxes on the image
-            logger.info("Drawing boxes on the image")
-            draw_boxes_on_meme(input_path, boxes_data, output_path)
-            
-            # Upload the modified image to the CDN
-            logger.info("Uploading modified image to CDN")
-            uploader = S3Uploader()
-            
-            # Generate a unique ID for the image
-            image_id = str(uuid.uuid4())
-            
-            # Open the output image and upload it
-            with Image.open(output_path) as img:
-                cdn_url = uploader.upload_image(img, f"rectangle_overlay_{image_id}")
-                
-            logger.info(f"Image uploaded to CDN: {cdn_url}")
-            return {"image_url": cdn_url}
-        finally:
-            # Clean up temporary files
-            if os.path.exists(input_path):
-                os.remove(input_path)
-            if os.path.exists(output_path):
-                os.remove(output_path)
+        # Download, draw and upload on the thread pool; all three steps block
+        cdn_url = await run_in_threadpool(overlay_and_upload, image_url, boxes_data)
+        
+        logger.info("Image uploaded to CDN: %s", cdn_url)
+        return {"image_url": cdn_url}
     except Exception as e:
         logger.error(f"Error overlaying rectangles: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
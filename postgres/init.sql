@@ -20,8 +20,10 @@ CREATE TABLE meme_templates (
 -- Add comment explaining text_box_coordinates format
 COMMENT ON COLUMN meme_templates.text_box_coordinates IS 'Array of JSON objects with format: [{"box_number": 1, "x": 10, "y": 5, "width": 80, "height": 20}, ...]. Coordinates are percentages of image dimensions.';
 
--- Create index for similarity search on meme_templates
-CREATE INDEX meme_templates_embedding_idx ON meme_templates USING ivfflat (embedding vector_l2_ops);
+-- Create HNSW indexes for similarity search on meme_templates (L2 for <->, cosine for <=>).
+-- Unlike ivfflat, HNSW needs no training data, so building it on the empty table is fine.
+CREATE INDEX meme_templates_embedding_idx ON meme_templates USING hnsw (embedding vector_l2_ops) WITH (m = 16, ef_construction = 200);
+CREATE INDEX meme_templates_embedding_cosine_idx ON meme_templates USING hnsw (embedding vector_cosine_ops) WITH (m = 16, ef_construction = 200);
 
 -- Create users table
 CREATE TABLE users (
@@ -74,8 +76,6 @@ CREATE INDEX ON memes(user_id);
 CREATE INDEX ON user_interactions(user_id);
 CREATE INDEX ON user_interactions(meme_id);
 
--- Create vector similarity search index for meme templates
-CREATE INDEX ON meme_templates USING ivfflat (embedding vector_cosine_ops);
 
 
 